@@ -1,12 +1,25 @@
 #!/usr/bin/env python3
-import json, time, re, sys
+import asyncio, json, os, time, re, sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
+from lxml import etree
+try:
+    import orjson
+except ImportError:  # plain json works too, just slower
+    orjson = None
 
 OUT = Path("data/volleyball.json")
 OUT.parent.mkdir(parents=True, exist_ok=True)
 
+# per-URL ETag/Last-Modified plus the by_team parsed from that response;
+# bump CACHE_VERSION whenever parse_class_page's output shape changes
+CACHE = Path("data/.cache.json")
+CACHE_VERSION = 4
+
+# returned by fetch_async when the server answers 304 Not Modified
+NOT_MODIFIED = object()
+
 CLASS_URLS = {
     "A":  "https://nsaa-static.s3.amazonaws.com/calculate/showclassvbA.html",
     "B":  "https://nsaa-static.s3.amazonaws.com/calculate/showclassvbB.html",
@@ -16,130 +29,263 @@ CLASS_URLS = {
     "D2": "https://nsaa-static.s3.amazonaws.com/calculate/showclassvbD2.html",
 }
 
+# columns we carry over from each NSAA schedule table, in output order
+ROW_FIELDS = ("Date", "Opponent", "Class", "W-L", "W/L", "Score", "Points",
+              "Tournament Name", "Tournament Location", "Site", "Time",
+              "Home/Away", "Div")
+# low-cardinality columns ("A".."D2", "W"/"L", "Home"/"Away", "-") repeated on
+# thousands of rows; interning lets every row share one string object
+INTERN_FIELDS = ("Class", "W/L", "Home/Away", "Div")
+
+_NORM_RE = re.compile(r"[^a-z0-9]+")
+_CAP_PAREN_RE = re.compile(r"\s*\([\d\-]+\)\s*$")
+# any cell of the per-team totals block that follows the schedule rows
+_TOTALS_RE = re.compile(r"Total Points|Average Points|Win %")
+
 def norm(s: str) -> str:
-    return re.sub(r"[^a-z0-9]+", "", (s or "").lower())
+    return _NORM_RE.sub("", (s or "").lower())
 
-def fetch(url: str) -> str:
-    r = requests.get(url, timeout=30)
-    r.raise_for_status()
-    return r.text
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
 
-def _cells(tr):
-    # collect text from th or td; NSAA often uses <td> for header row
-    return [c.get_text(" ", strip=True) for c in tr.find_all(["th", "td"])]
+def write_atomic(path: Path, data: bytes):
+    # readers (the board, the commit step) never see a half-written file
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
 
-def parse_class_page(html: str, cls_code: str):
-    soup = BeautifulSoup(html, "lxml")
-    by_team = {}
+def load_cache() -> dict:
+    try:
+        cache = json.loads(CACHE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    if cache.get("version") != CACHE_VERSION:
+        return {}
+    return cache.get("urls", {})
+
+def save_cache(entries: dict):
+    write_atomic(CACHE, dumps({"version": CACHE_VERSION, "urls": entries}))
+
+async def fetch_async(session: aiohttp.ClientSession, url: str, cached, cls_code: str):
+    """Return (by_team, validators); by_team is NOT_MODIFIED on a 304.
+
+    The body is fed to a TableTarget parser chunk by chunk as it arrives, so
+    parsing overlaps the download and the page is never held as one string.
+    """
+    loop = asyncio.get_running_loop()
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    async with session.get(url, headers=headers,
+                           timeout=aiohttp.ClientTimeout(total=30)) as resp:
+        if resp.status == 304:
+            print(f"{url.rsplit('/', 1)[-1]}: not modified", file=sys.stderr)
+            return NOT_MODIFIED, cached
+        resp.raise_for_status()
+        validators = {"etag": resp.headers.get("ETag"),
+                      "last_modified": resp.headers.get("Last-Modified")}
+        # a bare "text/html" has no charset; resp.text() used to decode that as
+        # UTF-8 (aiohttp's fallback), whereas libxml2 would guess Latin-1
+        parser = etree.HTMLParser(target=TableTarget(), encoding=resp.charset or "utf-8")
+        size = 0
+        # feed/assemble run on one helper thread per page (lxml wants a parser
+        # kept to a single thread), so the event loop keeps the other
+        # downloads moving; pages answered with 304 never start one
+        with ThreadPoolExecutor(max_workers=1) as ex:
+            async for chunk in resp.content.iter_chunked(65536):  # already gunzipped
+                size += len(chunk)
+                await loop.run_in_executor(ex, parser.feed, chunk)
+            by_team = await loop.run_in_executor(
+                ex, lambda: parse_class_page(parser.close(), cls_code))
+        # Content-Length is the on-the-wire (compressed) size when gzip is used
+        enc = resp.headers.get("Content-Encoding", "identity")
+        print(f"{url.rsplit('/', 1)[-1]}: {resp.content_length or '?'} bytes ({enc}), "
+              f"{size} bytes decoded", file=sys.stderr)
+        return by_team, validators
+
+async def fetch_all(class_urls, cache):
+    # one session, all class pages in flight at once; its default connector
+    # already pools keep-alive connections to the shared S3 host
+    headers = {"Accept-Encoding": "gzip"}  # table-heavy HTML compresses ~5-10x
+    async with aiohttp.ClientSession(headers=headers) as session:
+        return await asyncio.gather(*(fetch_async(session, u, cache.get(u), cls)
+                                      for cls, u in class_urls.items()),
+                                    return_exceptions=True)
+
+# marks an element boundary (<a>, <br>, ...) inside a cell's text chunks;
+# the HTML parser never passes NUL through as text
+_NODE_BREAK = "\x00"
+
+def _text(chunks, sep=" ") -> str:
+    # same result as BeautifulSoup's get_text(sep, strip=True): lxml may hand
+    # one text node over in several data() calls (e.g. around "&gt;"), so glue
+    # chunks back into nodes first, then strip each node, drop blanks, join
+    return sep.join(filter(None, map(str.strip, "".join(chunks).split(_NODE_BREAK))))
+
+class TableTarget:
+    """lxml parser target that collects captioned tables without building a tree.
+
+    close() returns a list of (caption_text, rows), where each row is a list of
+    (tag, text) cells with tag being "th" or "td".
+    """
+
+    def __init__(self):
+        self.tables = []
+        self._caption = None   # caption text of the table being read
+        self._cap_buf = None   # text chunks while inside <caption>
+        self._rows = None      # rows of the table being read
+        self._row = None       # cells of the <tr> being read
+        self._cell = None      # text chunks while inside <th>/<td>
+        self._cell_tag = None
 
-    # Each team table has a <caption><b>Team (x-y)</b></caption>
-    for cap in soup.find_all("caption"):
-        team_display = cap.get_text(strip=True)
-        table = cap.find_parent("table")
-        if not table:
-            continue
+    def _node_break(self):
+        # an element or comment ends the current text node
+        if self._cell is not None:
+            self._cell.append(_NODE_BREAK)
+        elif self._cap_buf is not None:
+            self._cap_buf.append(_NODE_BREAK)
 
-        team_name = re.sub(r"\s*\([\d\-]+\)\s*$", "", team_display).strip()
+    def start(self, tag, attrib):
+        self._node_break()
+        if tag == "table":
+            self._caption = None
+            self._rows = []
+        elif tag == "caption":
+            self._cap_buf = []
+        elif tag == "tr" and self._rows is not None:
+            # rows are only collected inside a table; tables that turn out to
+            # have no caption are dropped at end("table") wherever the caption sits
+            self._row = []
+        elif tag in ("th", "td") and self._row is not None:
+            self._cell = []
+            self._cell_tag = tag
+
+    def data(self, text):
+        if self._cell is not None:
+            self._cell.append(text)
+        elif self._cap_buf is not None:
+            self._cap_buf.append(text)
+
+    def comment(self, text):
+        self._node_break()
+
+    def end(self, tag):
+        self._node_break()
+        if tag in ("th", "td"):
+            if self._cell is not None:
+                self._row.append((self._cell_tag, _text(self._cell)))
+                self._cell = None
+        elif tag == "tr":
+            if self._row is not None and self._rows is not None:
+                self._rows.append(self._row)
+            self._row = None
+        elif tag == "caption":
+            if self._cap_buf is not None and self._caption is None:
+                # the old caption.get_text(strip=True) joined nodes with no separator
+                self._caption = _text(self._cap_buf, "")
+            self._cap_buf = None
+        elif tag == "table":
+            # Each team table has a <caption><b>Team (x-y)</b></caption>
+            if self._caption is not None and self._rows is not None:
+                self.tables.append((self._caption, self._rows))
+            self._caption = None
+            self._rows = None
+
+    def close(self):
+        tables, self.tables = self.tables, []
+        return tables
+
+def parse_class_page(tables, cls_code: str):
+    # tables: what a TableTarget parser returns for one class page
+    by_team = {}
+
+    for team_display, table_rows in tables:
+        team_name = _CAP_PAREN_RE.sub("", team_display).strip()
         key = norm(team_name)
 
-        # ---- locate the header row (could be <td> or <th>)
-        headers = []
-        header_tr = None
-        for tr in table.find_all("tr"):
-            cells = _cells(tr)
-            if not cells:
+        # single pass: skip rows until the header row (could be <td> or <th>;
+        # NSAA often uses <td>), then treat everything after it as data.
+        # A table without a usable header never yields rows.
+        field_map = None
+        rows = []
+        for cells in table_rows:
+            if field_map is None:
+                # normalize plural header to singular for our field map
+                headers = [text.replace("Opponents", "Opponent") for _, text in cells]
+                if "Date" in headers and "Opponent" in headers:
+                    # header -> column, built once; reversed so the first of any
+                    # duplicate header wins, as headers.index() used to
+                    hpos = {h: i for i, h in reversed(list(enumerate(headers)))}
+                    # (output key, column index) for every known field in this table
+                    field_map = [(name, hpos[name]) for name in ROW_FIELDS if name in hpos]
                 continue
-            # normalize plural header to singular for our field map
-            cells_norm = [c.replace("Opponents", "Opponent") for c in cells]
-            if "Date" in cells_norm and "Opponent" in cells_norm:
-                headers = cells_norm
-                header_tr = tr
-                break
-        if not headers or not header_tr:
-            # no usable header -> skip this table
-            continue
-
-        # column index helper
-        def idx(col):
-            try:
-                return headers.index(col)
-            except ValueError:
-                return None
-
-        i_date  = idx("Date")
-        i_opp   = idx("Opponent")
-        i_cls   = idx("Class")
-        i_wlopp = idx("W-L")
-        i_wl    = idx("W/L")
-        i_score = idx("Score")
-        i_pts   = idx("Points")
-        i_tn    = idx("Tournament Name")
-        i_tloc  = idx("Tournament Location")
-        i_site  = idx("Site")
-        i_time  = idx("Time")
-        i_ha    = idx("Home/Away")
-        i_div   = idx("Div")
 
-        rows = []
-        for tr in header_tr.find_next_siblings("tr"):
-            tds = [td.get_text(" ", strip=True) for td in tr.find_all("td")]
+            tds = [text for tag, text in cells if tag == "td"]
             if not tds:
                 continue
 
             # stop when we hit the totals block
-            if any(("Total Points" in x) or ("Average Points" in x) or ("Win %" in x) for x in tds):
+            if any(map(_TOTALS_RE.search, tds)):
                 break
             # skip the HR separator row: often a single TD with <hr>
             if len(tds) == 1 and ("hr" in tds[0].lower() or tds[0] == "-"):
                 continue
-
-            def val(i):
-                return tds[i] if i is not None and i < len(tds) else None
-
-            row = {}
-            if i_date is not None:  row["Date"] = val(i_date)
-            if i_opp  is not None:  row["Opponent"] = val(i_opp)
-            if i_cls  is not None:  row["Class"] = val(i_cls)
-            if i_wlopp is not None: row["W-L"] = val(i_wlopp)
-            if i_wl   is not None:  row["W/L"] = val(i_wl)
-            if i_score is not None: row["Score"] = val(i_score)
-            if i_pts  is not None:  row["Points"] = val(i_pts)
-            if i_tn   is not None:  row["Tournament Name"] = val(i_tn)
-            if i_tloc is not None:  row["Tournament Location"] = val(i_tloc)
-            if i_site is not None:  row["Site"] = val(i_site)
-            if i_time is not None:  row["Time"] = val(i_time)
-            if i_ha   is not None:  row["Home/Away"] = val(i_ha)
-            if i_div  is not None:  row["Div"] = val(i_div)
-
-            # attach helpers the UI expects
-            row["_team"] = team_name
-            row["_team_display"] = team_display
-            row["_class"] = (row.get("Class") or cls_code)
-
-            # skip blank-ish rows
-            if not any(v and v != "-" for v in row.values()):
+            # skip blank-ish rows before building anything for them
+            if not any(c and c != "-" for c in tds):
                 continue
 
+            row = {k: tds[i] for k, i in field_map if i < len(tds)}
+            for k in INTERN_FIELDS:
+                v = row.get(k)
+                if v is not None:
+                    row[k] = sys.intern(v)
             rows.append(row)
 
-        if rows:
-            by_team[key] = rows
+        if field_map is not None:
+            # team-level fields are stored once, not on every row; keep teams
+            # with no games yet so the board can tell them apart from a name
+            # that didn't match any caption
+            by_team[key] = {"team": team_name, "team_display": team_display,
+                            "class": cls_code, "rows": rows}
 
     return by_team
 
 def main():
     all_by_team = {}
-    for cls, url in CLASS_URLS.items():
+    cache = load_cache()
+    fetched = asyncio.run(fetch_all(CLASS_URLS, cache))
+
+    # merge in CLASS_URLS order so later classes win on key clashes, as before
+    for (cls, url), res in zip(CLASS_URLS.items(), fetched):
         try:
-            html = fetch(url)
-            got = parse_class_page(html, cls)
+            if isinstance(res, BaseException):
+                raise res
+            got, validators = res
+            if got is NOT_MODIFIED:
+                got = cache[url]["by_team"]
+            else:
+                cache[url] = {**validators, "by_team": got}
             all_by_team.update(got)
         except Exception as e:
             print(f"[WARN] {cls} failed: {e}", file=sys.stderr)
 
-    OUT.write_text(json.dumps({"updated": int(time.time()), "by_team": all_by_team},
-                              ensure_ascii=False),
-                   encoding="utf-8")
+    save_cache(cache)
+
+    # leave the file (and its mtime / "updated" stamp) alone if nothing changed
+    try:
+        previous = json.loads(OUT.read_text(encoding="utf-8")).get("by_team")
+    except (OSError, ValueError, AttributeError):
+        previous = None
+    if previous == all_by_team:
+        print(f"Unchanged {OUT.resolve()}")
+        return
+
+    write_atomic(OUT, dumps({"updated": int(time.time()), "by_team": all_by_team}))
     print(f"Wrote {OUT.resolve()}")
 
 if __name__ == "__main__":